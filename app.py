@@ -1,14 +1,39 @@
 import streamlit as st
-import google.generativeai as genai
-import pdfplumber
 from dotenv import load_dotenv
 import os
 import json
 import io
-import traceback
 import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import re
-from collections import Counter
+import hashlib
+import threading
+import datetime
+import math
+import heapq
+import sqlite3
+import time
+import zlib
+import random
+from contextlib import closing
+from html import escape
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+try:
+    import orjson  # C-accelerated JSON; stdlib json is the fallback
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj, sort_keys=False):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+except ImportError:
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj, sort_keys=False):
+        return json.dumps(obj, sort_keys=sort_keys)
 
 # --- CONFIGURATION & SETUP ---
 load_dotenv()
@@ -26,149 +51,464 @@ if "GOOGLE_API_KEY" in os.environ:
 else:
     api_key = st.sidebar.text_input("Enter Google API Key", type="password")
 
-if api_key:
-    try:
-        genai.configure(api_key=api_key)
-    except Exception as e:
-        st.error(f"API Key Error: {e}")
-
 # --- HELPERS ---
 
-STOPWORDS = set("""
+MODEL_NAME = os.getenv("KADAK_MODEL", "gemini-2.5-flash")
+MODEL_OPTIONS = list(dict.fromkeys([MODEL_NAME, "gemini-2.5-flash", "gemini-2.5-pro"]))  # default first
+KEYWORD_MODEL_NAME = "gemini-2.5-flash-lite"  # extractive task: lighter, faster model
+# Deadlines so a stuck stream can't hang the script run (song generation can take minutes)
+SONGS_REQUEST_OPTIONS = {"timeout": 300}
+KEYWORD_REQUEST_OPTIONS = {"timeout": 120}
+SONG_FANOUT_WORKERS = 4  # concurrent per-style song requests (free-tier QPS is low)
+GEMINI_ATTEMPTS = 3  # tries per request on transient errors (rate limit, 5xx, deadline)
+GEMINI_BACKOFF_MAX = 30  # seconds; waits go 1, 2, 4, ... (+ up to 1s jitter) capped here
+
+# Heavy SDKs (google-generativeai, pdfminer) are imported on first use, not at
+# startup, so the first render doesn't wait on grpc/pdfminer imports.
+
+@st.cache_resource(show_spinner=False)
+def _genai_config_state():
+    # survives reruns (a module-level lru_cache is rebuilt every run)
+    return {"lock": threading.Lock(), "key_fingerprint": None}
+
+def _get_genai(key):
+    """
+    Import google.generativeai configured for `key`. genai.configure is process-global and
+    shared by all sessions, so it only re-runs when the key differs from the last one set.
+    """
+    import google.generativeai as genai
+    state = _genai_config_state()
+    fingerprint = hashlib.sha256(key.encode()).hexdigest()
+    with state["lock"]:
+        if state["key_fingerprint"] != fingerprint:
+            genai.configure(api_key=key)
+            state["key_fingerprint"] = fingerprint
+    return genai
+
+@st.cache_resource(show_spinner=False)
+def _cached_model(name, key_fingerprint):
+    return _get_genai(api_key).GenerativeModel(name)
+
+def get_model(name=MODEL_NAME):
+    """One GenerativeModel per (model name, API key), shared across calls and reruns."""
+    return _cached_model(name, api_key_fingerprint())
+
+_TRANSIENT_ERRORS = frozenset({
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "GatewayTimeout", "Aborted",
+})
+
+def _is_transient(exc):
+    # matched by class name so google.api_core needn't be imported up front
+    return type(exc).__name__ in _TRANSIENT_ERRORS or isinstance(exc, (TimeoutError, ConnectionError))
+
+def call_with_backoff(fn, *args, **kwargs):
+    """Call `fn`, retrying transient Gemini errors with jittered exponential backoff; other errors raise at once."""
+    for attempt in range(GEMINI_ATTEMPTS):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == GEMINI_ATTEMPTS - 1 or not _is_transient(e):
+                raise
+            # jitter keeps concurrent fan-out requests from retrying in lockstep into the same 429
+            time.sleep(min(GEMINI_BACKOFF_MAX, 2 ** attempt + random.random()))
+
+STOPWORDS = frozenset("""
 the and for with that this from are is was were be by to of in on as an at it its which a an
 """.split())
+_STOPWORDS_B = frozenset(w.encode() for w in STOPWORDS)
+
+# Precompiled patterns (keyword extraction + lyric post-processing)
+_RE_STRIP_PUNCT = re.compile(r"[^A-Za-z0-9]")
+_RE_SPLIT_KW = re.compile(r"[,;\s]+")
+_RE_LATEX = re.compile(r"\$\$.*?\$\$|\$.*?\$", re.S)  # $$...$$ tried first at each position, then $...$
+_RE_OPERATOR_RICH = re.compile(r"[^\n]{0,40}[=↔→<>+\-/*^]{2,}[^\n]{0,40}")
+_RE_ANY_NUM = re.compile(r"\b\d+\b")
+_RE_PLACEHOLDER_REPEAT = re.compile(r"\[(formula|num)\]\s*(?:\[\1\]\s*)+")
+_RE_MULTINEWLINE = re.compile(r"\n{3,}")
+_RE_MULTISPACE = re.compile(r"[ \t]{2,}")
+_RE_BLANK_LINES = re.compile(r"\n\s*\n")
+_RE_HYPHEN_BREAK = re.compile(r"-\n(?=\w)")
+_RE_PAGE_NUM_LINE = re.compile(r"\n[ \t]*\d{1,3}[ \t]*\n")
+_RE_HSPACE = re.compile(r"[ \t]+")
+_RE_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+")
+_RE_SONG_BLOCK = re.compile(r"^TYPE:[ \t]*(.+?)\nTITLE:[ \t]*(.+?)\nVIBE:[ \t]*(.+?)\nLYRICS:[ \t]*\n(.*?)\n--END--", re.S | re.M)
+_PAGE_SEP = "\x1e"
+_PAGE_SEP_B = _PAGE_SEP.encode()
+_RE_WORD = re.compile(rb"[a-z0-9]{4,}|\x1e")
+_RE_PAGE_PREFIX = re.compile(r"^(?:page\s*)?(\d+)\s*[:.)\-]\s*", re.I)
+_RE_FENCE = re.compile(r"```[\w-]*[ \t]*\n?")  # markdown fence, with its language tag
+_RE_NEEDS_CLEAN = re.compile(r"[$=↔→<>+\-/*^\d]")  # any formula char or digit
+
+def _pdfminer_text(stream, page_numbers=None, maxpages=0):
+    """Plain text straight from pdfminer's text converter; pages end with a form feed."""
+    from pdfminer.high_level import extract_text_to_fp
+    from pdfminer.layout import LAParams
 
-def extract_text_from_pdf(pdf_file, max_pages=35):
+    out = io.StringIO()
+    # boxes_flow=None keeps char->line->box grouping (needed for spaces/newlines) but skips
+    # pdfminer's hierarchical text-box ordering pass, the expensive part of layout analysis
+    extract_text_to_fp(stream, out, page_numbers=page_numbers, maxpages=maxpages, laparams=LAParams(boxes_flow=None))
+    return out.getvalue()
+
+def _count_pages(stream, limit=0):
+    """Page count, stopping at `limit` (0 = no limit) so long PDFs aren't walked to the end."""
+    from pdfminer.pdfpage import PDFPage
+
+    stream.seek(0)
+    n = sum(1 for _ in PDFPage.get_pages(stream, maxpages=limit))
+    stream.seek(0)
+    return n
+
+def _extract_one_page(idx, pdf_bytes):
+    """
+    Extract text for a single page from `pdf_bytes`.
+    A page that fails to parse yields "" so it can't sink the whole chapter.
+    """
+    try:
+        return _pdfminer_text(io.BytesIO(pdf_bytes), page_numbers=[idx])
+    except Exception:
+        return ""
+
+def _pdf_bytes(pdf_file):
+    """Upload bytes without an extra copy (UploadedFile/BytesIO share their buffer via getvalue)."""
+    if hasattr(pdf_file, "getvalue"):
+        return pdf_file.getvalue()
+    pdf_file.seek(0)
+    return pdf_file.read()
+
+def pdf_digest(pdf_file):
+    """blake2b hex digest of the upload, computed straight off the stream (no extra full-size buffer)."""
+    pdf_file.seek(0)
+    try:
+        digest = hashlib.file_digest(pdf_file, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+    except AttributeError:  # Python < 3.11
+        h = hashlib.blake2b(digest_size=16)
+        for chunk in iter(lambda: pdf_file.read(1 << 16), b""):
+            h.update(chunk)
+        digest = h.hexdigest()
+    pdf_file.seek(0)
+    return digest
+
+@st.cache_resource(show_spinner=False)
+def _pdfium_lock():
+    # PDFium is not thread-safe and Streamlit runs each session on its own thread:
+    # one process-wide lock (cache_resource survives reruns, a module-level lock wouldn't)
+    return threading.Lock()
+
+def _pdfium_pages(raw, max_pages, char_budget=None):
+    """
+    Per-page text via PDFium (C++), the fast path. Raises ImportError if pypdfium2 is missing.
+    Stops after the page that brings the total past `char_budget`.
+    """
+    import pypdfium2 as pdfium
+
+    with _pdfium_lock():
+        return _pdfium_read(pdfium, raw, max_pages, char_budget)
+
+def _pdfium_read(pdfium, raw, max_pages, char_budget):
+    """Body of `_pdfium_pages`; caller must hold `_pdfium_lock()`."""
+    pdf = pdfium.PdfDocument(raw)
+    try:
+        texts = []
+        total = 0
+        for i in range(min(len(pdf), max_pages)):
+            if char_budget and total >= char_budget:
+                break
+            page = pdf[i]
+            textpage = page.get_textpage()
+            texts.append(textpage.get_text_range().replace("\r\n", "\n").replace("\r", "\n"))
+            total += len(texts[-1])
+            textpage.close()
+            page.close()
+        return texts
+    finally:
+        pdf.close()
+
+def _pdfminer_pages(raw, max_pages):
+    """
+    Per-page text via pdfminer.six, the fallback when PDFium is unavailable or finds no text.
+    Runs in-process: a process pool can't be started safely from the Streamlit server
+    (fork with live server threads can deadlock; spawn can't import this script's helpers).
+    """
+    stream = io.BytesIO(raw)  # shares the bytes until written to, no copy
+    pages_to = _count_pages(stream, limit=max_pages)
+    try:
+        return _pdfminer_text(stream, maxpages=pages_to).split("\f")[:pages_to]
+    except Exception:
+        # one broken page aborts the single-pass parse; retry page by page
+        return [_extract_one_page(i, raw) for i in range(pages_to)]
+
+# Stop extracting once this much text is in hand: a few times the song prompt's source
+# budget, so relevance trimming still has the whole chapter to pick from on normal PDFs.
+EXTRACT_CHAR_BUDGET = 240_000
+
+def _within_budget(page_texts, char_budget):
+    """Leading pages up to and including the one that reaches `char_budget`."""
+    total = 0
+    for n, t in enumerate(page_texts, 1):
+        total += len(t)
+        if total >= char_budget:
+            return page_texts[:n]
+    return page_texts
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _extract_text_cached(digest, _raw, max_pages=35, char_budget=EXTRACT_CHAR_BUDGET):
+    """
+    Cached on the PDF digest (so Streamlit doesn't re-hash the bytes): re-clicking
+    Generate on the same upload skips parsing.
+    PDFium first; pdfminer when pypdfium2 is unavailable, fails, or finds no text.
+    Raises on unreadable PDFs (exceptions are not cached).
+    """
+    try:
+        page_texts = _pdfium_pages(_raw, max_pages, char_budget)
+    except Exception:
+        page_texts = None
+    if not page_texts or not any(t.strip() for t in page_texts):
+        page_texts = _within_budget(_pdfminer_pages(_raw, max_pages), char_budget)
+    # blank lines are the page separator downstream, so collapse the ones inside a page
+    page_texts = [_RE_BLANK_LINES.sub("\n", t).strip() for t in page_texts]
+    return "\n\n".join(t for t in page_texts if t)
+
+def extract_text_from_pdf(pdf_file, max_pages=35, digest=None):
     """
     Reads up to `max_pages` pages from uploaded PDF (safe for Streamlit UploadedFile).
+    Text comes from PDFium, with pdfminer as the fallback; results are cached on
+    the file contents.
     Returns a single string with page blocks separated by double newlines.
     """
-    text = ""
     try:
-        try:
-            pdf_file.seek(0)
-        except Exception:
-            pass
-        raw_bytes = pdf_file.read()
-        file_obj = io.BytesIO(raw_bytes)
-        with pdfplumber.open(file_obj) as pdf:
-            total = len(pdf.pages)
-            pages_to = min(total, max_pages)
-            for i in range(pages_to):
-                p = pdf.pages[i]
-                page_text = p.extract_text()
-                if page_text:
-                    text += page_text.strip() + "\n\n"
+        digest = digest or pdf_digest(pdf_file)
+        return _extract_text_cached(digest, _pdf_bytes(pdf_file), max_pages)
     except Exception as e:
-        tb = traceback.format_exc()
-        st.error(f"Error reading PDF: {e}\n\n{tb}")
+        st.error(f"Error reading PDF: {type(e).__name__}: {e}")
+        if DEBUG:
+            st.exception(e)
         return None
-    return text
+
+def _iter_json_objs(s):
+    """Single forward pass over `s`, yielding each balanced top-level {...} substring (string-aware)."""
+    depth = 0
+    start = -1
+    in_str = False
+    esc = False
+    for i, c in enumerate(s):
+        if in_str:
+            if esc:
+                esc = False
+            elif c == "\\":
+                esc = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            if depth:
+                in_str = True
+        elif c == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                yield s[start:i+1]
 
 def try_parse_json(raw_text):
-    """Robust attempt to parse JSON from model output, or extract first {...} block."""
+    """Robust attempt to parse JSON from model output, or the first balanced {...} block that parses."""
     if not raw_text:
         return None
     try:
-        return json.loads(raw_text)
+        return json_loads(raw_text)
     except Exception:
         pass
-    start = raw_text.find("{")
-    end = raw_text.rfind("}")
-    if start != -1 and end != -1 and end > start:
-        candidate = raw_text[start:end+1]
+    for candidate in _iter_json_objs(raw_text):
         try:
-            return json.loads(candidate)
+            return json_loads(candidate)
         except Exception:
-            pass
+            continue
     return None
 
-def local_single_word_keywords(page_text, topn=10):
+LOCAL_KW_PAGE_CHARS = 4000  # word frequencies settle well before this; longer pages are cut
+
+def local_keywords_all_pages(pages, topn=10):
     """
-    Local fallback: extract top single-word technical keywords from a page.
-    Filters stopwords, short tokens and digits.
+    Local fallback: top single-word technical keywords per page (stopwords, short
+    tokens and digits filtered). One regex sweep over all pages joined by a
+    record-separator sentinel, tokens partitioned back per page and counted with
+    a single Counter() build each.
+    Returns a list of keyword lists, one per page.
     """
-    txt = re.sub(r"[^A-Za-z0-9\s]", " ", page_text)
-    tokens = [t.lower() for t in txt.split() if len(t) > 3 and not t.isdigit()]
-    if not tokens:
-        return []
-    counts = Counter(tokens)
-    # remove stopwords
-    for s in list(counts):
-        if s in STOPWORDS:
-            del counts[s]
-    common = [w for w, _ in counts.most_common(topn)]
-    return common[:topn]
+    # scan UTF-8 bytes: bytes.lower() touches only ASCII, and non-ASCII bytes never match
+    joined = _PAGE_SEP.join(p[:LOCAL_KW_PAGE_CHARS].replace(_PAGE_SEP, " ") for p in pages).encode("utf-8").lower()
+    tokens = [[] for _ in pages]
+    page_idx = 0
+    for tok in _RE_WORD.findall(joined):
+        if tok == _PAGE_SEP_B:
+            page_idx += 1
+        elif not tok.isdigit() and tok not in _STOPWORDS_B:
+            tokens[page_idx].append(tok)
+    return [[w.decode("ascii") for w, _ in Counter(t).most_common(topn)] for t in tokens]
 
-def generate_keywords_per_page(text_content, max_pages=35):
+def _page_digest(page_text, limit=1500, n_longest=5):
+    """Representative snippet for the keyword prompt: first, longest few and last sentence (page order)."""
+    if len(page_text) <= limit:
+        return page_text
+    sents = _RE_SENTENCE_SPLIT.split(page_text)
+    if len(sents) <= 2:
+        return page_text[:limit]
+    middle = heapq.nlargest(n_longest, range(1, len(sents) - 1), key=lambda i: len(sents[i]))
+    picks = [0] + sorted(middle) + [len(sents) - 1]
+    return " ".join(sents[i] for i in picks)[:limit]
+
+# Snippets are capped at 1500 chars, so a 35-page chapter is at most ~52k chars: the budget
+# must sit well below that for long chapters to actually split into concurrent batches.
+KW_BATCH_BUDGET = 12_000  # max snippet chars in one batched keyword prompt
+KW_BATCH_PAGES = 8  # pages per prompt once the budget is exceeded
+KW_BATCH_WORKERS = 4  # concurrent keyword prompts in flight
+
+def _keyword_batches(snippets):
+    """Group snippet indices: everything in one prompt if it fits the budget, else fixed-size groups."""
+    idxs = list(range(len(snippets)))
+    if sum(len(s) for s in snippets) <= KW_BATCH_BUDGET:
+        return [idxs] if idxs else []
+    return [idxs[i:i + KW_BATCH_PAGES] for i in range(0, len(idxs), KW_BATCH_PAGES)]
+
+def _parse_keyword_line(line, limit=10):
+    """Turn one line of model output into up to `limit` unique, cleaned single-word keywords."""
+    line = _RE_PAGE_PREFIX.sub("", line.strip())
+    # split by commas or whitespace, filter to single words, remove punctuation
+    cand = [_RE_STRIP_PUNCT.sub("", c).lower() for c in _RE_SPLIT_KW.split(line) if c.strip()]
+    kws = []
+    seen = set()
+    for c in cand:
+        if len(c) > 2 and not c.isdigit() and c not in STOPWORDS and c not in seen:
+            seen.add(c)
+            kws.append(c)
+            if len(kws) >= limit:
+                break
+    return kws
+
+def _batch_keywords(model, snippets):
+    """
+    One model call for several pages; returns (keyword list per snippet, empty where missing,
+    and whether the reply had exactly one usable line per page).
+    Lines are matched to pages by their "N:" number, not position, so a skipped line can't shift
+    later pages' keywords.
+    """
+    blocks = "\n".join(f"### PAGE {i}\n{snip}" for i, snip in enumerate(snippets, start=1))
+    prompt = f"""
+Extract up to 10 single-word keywords that best capture EACH page's content.
+Return EXACTLY {len(snippets)} lines, one per page, in page order, each starting with its page number: "N: word, word, ...".
+After the number, each line is ONLY a comma-separated list of single words (no phrases, no explanations).
+Prefer technical concepts, names or terms a student would search for. Avoid stopwords and numbers.
+
+{blocks}
+"""
+    # ~10 short words per page line; cap decode length accordingly
+    resp = call_with_backoff(model.generate_content, prompt, generation_config={
+        "max_output_tokens": 40 * len(snippets) + 64,
+        "temperature": 0.2,
+        "candidate_count": 1,
+    }, request_options=KEYWORD_REQUEST_OPTIONS)
+    text = resp.text or ""
+    cleaned = (_RE_FENCE.sub("", text) if "```" in text else text).strip()  # fences are rare: skip the scan
+    kws = [[] for _ in snippets]
+    exact = True
+    for ln in cleaned.splitlines():
+        if not ln.strip():
+            continue
+        m = _RE_PAGE_PREFIX.match(ln.strip())
+        if not m:
+            exact = False  # unnumbered line: can't tell which page it belongs to
+            continue
+        n = int(m.group(1))
+        if 1 <= n <= len(snippets) and not kws[n - 1]:
+            kws[n - 1] = _parse_keyword_line(ln)
+        else:
+            exact = False  # out-of-range or repeated page number
+    return kws, exact and all(kws)
+
+def generate_keywords_per_page(text_content, max_pages=35, persist_key=None):
     """
     For each page block in text_content (split by blank line),
     return a line containing up to 10 single-word keywords for that page.
     The returned string has one line per page (number of lines == pages read).
-    Try the model per page, fallback to local single-word extraction.
+    Pages are batched into as few model calls as the prompt budget allows;
+    pages the model leaves blank fall back to local single-word extraction.
+    With `persist_key`, a result where every model batch succeeded is stored on disk.
     """
     if not text_content:
         return "No text to summarise."
 
-    pages = [p.strip() for p in text_content.split("\n\n") if p.strip()]
-    pages = pages[:max_pages]
+    # extraction already strips pages and collapses blank lines inside them, so "\n\n" splits
+    # exactly at page boundaries; maxsplit stops scanning once max_pages are found
+    pages = [p for p in text_content.split("\n\n", max_pages)[:max_pages] if p and not p.isspace()]
 
-    model_available = bool(api_key)
     model = None
-    if model_available:
+    if api_key:
         try:
-            model = genai.GenerativeModel("gemini-2.5-flash")
+            model = get_model(KEYWORD_MODEL_NAME)
         except Exception:
-            model_available = False
             model = None
 
-    results = []
-    for idx, page_text in enumerate(pages, start=1):
-        snippet = page_text[:12000]
-        kws = []
-        if model_available and model is not None:
-            prompt = f"""
-Extract up to 10 single-word keywords that best capture this page's content. 
-Return ONLY a comma-separated list of single words (no phrases, no explanations). 
-Prefer technical concepts, names or terms a student would search for. Avoid stopwords and numbers.
+    # identical pages (repeated boilerplate) share one snippet slot
+    snippets = []
+    slot_of_page = []
+    slot_by_hash = {}
+    for page_text in pages:
+        snippet = _page_digest(page_text)
+        page_hash = hashlib.blake2b(snippet.encode(), digest_size=8).digest()
+        if page_hash not in slot_by_hash:
+            slot_by_hash[page_hash] = len(snippets)
+            snippets.append(snippet)
+        slot_of_page.append(slot_by_hash[page_hash])
 
-PAGE TEXT:
-{snippet}
-"""
-            try:
-                resp = model.generate_content(prompt)
-                raw = (resp.text or "").strip()
-                cleaned = raw.replace("```", "").strip()
-                # take first non-empty line
-                first = ""
-                for ln in cleaned.splitlines():
-                    if ln.strip():
-                        first = ln.strip()
-                        break
-                if first:
-                    # split by commas or whitespace, filter to single words, remove punctuation
-                    cand = re.split(r",|;|\s+", first)
-                    cand = [re.sub(r"[^A-Za-z0-9]", "", c).lower() for c in cand if c.strip()]
-                    cand = [c for c in cand if len(c) > 2 and not c.isdigit() and c not in STOPWORDS]
-                    # unique preserve order
-                    seen = set()
-                    for c in cand:
-                        if c and c not in seen:
-                            seen.add(c)
-                            kws.append(c)
-                        if len(kws) >= 10:
-                            break
-            except Exception:
-                kws = []
+    slot_kws = [[] for _ in snippets]
+    groups = _keyword_batches(snippets) if model is not None else []
+    complete = bool(groups)
+    if groups:
+        # batch prompts are independent: submit them together and collect as they finish
+        with ThreadPoolExecutor(max_workers=min(len(groups), KW_BATCH_WORKERS)) as ex:
+            futures = {ex.submit(_batch_keywords, model, [snippets[i] for i in g]): g for g in groups}
+            for fut in as_completed(futures):
+                try:
+                    batch, exact = fut.result()
+                except Exception:
+                    complete = False
+                    continue
+                # missing/extra lines: usable for display, but not worth persisting
+                complete = complete and exact
+                for i, kws in zip(futures[fut], batch):
+                    slot_kws[i] = kws
 
+    results = []
+    fallback = None  # bulk local keywords, computed on first miss
+    for idx, slot in enumerate(slot_of_page):
+        kws = slot_kws[slot]
         if not kws:
-            kws = local_single_word_keywords(page_text, topn=10)
+            if fallback is None:
+                fallback = local_keywords_all_pages(pages, topn=10)
+            kws = fallback[idx]
+        results.append(", ".join(kws[:10]) if kws else "—")
+    result = "\n".join(results)
+    if persist_key and complete:
+        store_result(persist_key, result)
+    return result
 
-        if kws:
-            results.append(", ".join(kws[:10]))
-        else:
-            results.append("—")
-    return "\n".join(results)
+def _normalize_ws(s):
+    s = _RE_MULTINEWLINE.sub("\n\n", s)
+    s = _RE_MULTISPACE.sub(" ", s)
+    return s.strip()
+
+def _make_num_redactor(keep=6):
+    """re.sub callback: 4+ digit tokens become [num]; only the first `keep` short numbers survive."""
+    seen = [0]
+    def _redact(match):
+        tok = match.group(0)
+        if len(tok) >= 4:
+            return " [num] "
+        seen[0] += 1
+        return tok if seen[0] <= keep else " [num] "
+    return _redact
 
 def clean_lyrics(lyrics: str):
     """
@@ -179,79 +519,130 @@ def clean_lyrics(lyrics: str):
         return lyrics
     s = lyrics
 
-    # Remove LaTeX-like blocks between $...$ or $$...$$
-    s = re.sub(r"\$\$.*?\$\$", " [formula] ", s, flags=re.S)
-    s = re.sub(r"\$.*?\$", " [formula] ", s, flags=re.S)
+    # Fast path: nothing formula- or number-like, only whitespace needs normalising
+    if not _RE_NEEDS_CLEAN.search(s):
+        return _normalize_ws(s)
+
+    # Remove LaTeX-like blocks between $...$ or $$...$$ (one pass)
+    s = _RE_LATEX.sub(" [formula] ", s)
 
     # Replace long operator-rich fragments with placeholder
-    s = re.sub(r"[^\n]{0,40}[=↔→<>+\-/*^]{2,}[^\n]{0,40}", lambda m: " [formula] " if len(m.group(0))>12 else m.group(0), s)
-
-    # Replace long numeric tokens (4+ digits) with placeholder
-    s = re.sub(r"\b\d{4,}\b", " [num] ", s)
-
-    # Limit numeric tokens: if more than 6 numbers present, redact later ones
-    nums = re.findall(r"\b\d+\b", s)
-    if len(nums) > 6:
-        def _replace_late_nums(match):
-            if _replace_late_nums.count < 6:
-                _replace_late_nums.count += 1
-                return match.group(0)
-            return " [num] "
-        _replace_late_nums.count = 0
-        s = re.sub(r"\b\d+\b", _replace_late_nums, s)
+    s = _RE_OPERATOR_RICH.sub(lambda m: " [formula] " if len(m.group(0))>12 else m.group(0), s)
 
-    # compress repeated placeholders
-    s = re.sub(r"(\[formula\]\s*){2,}", "[formula] ", s)
-    s = re.sub(r"(\[num\]\s*){2,}", "[num] ", s)
+    # Redact long numeric tokens (4+ digits) and every number after the first 6 — one pass
+    s = _RE_ANY_NUM.sub(_make_num_redactor(), s)
+
+    # compress repeated placeholders (runs of [formula] or of [num]) in one pass
+    s = _RE_PLACEHOLDER_REPEAT.sub(r"[\1] ", s)
 
     # Trim extra spaces/newlines
-    s = re.sub(r"\n{3,}", "\n\n", s)
-    s = re.sub(r"[ \t]{2,}", " ", s)
-    s = s.strip()
-    return s
+    return _normalize_ws(s)
+
+def _condense(text):
+    """Shrink PDF text before prompting: re-join hyphenated line breaks, drop page-number lines, squeeze whitespace."""
+    text = _RE_HYPHEN_BREAK.sub("", text)
+    text = _RE_PAGE_NUM_LINE.sub("\n", text)
+    text = _RE_HSPACE.sub(" ", text)
+    return _RE_MULTINEWLINE.sub("\n\n", text).strip()
 
-def generate_songs(text_content, styles, language_mix, artist_ref, focus_topic, additional_instructions, duration_minutes):
+SOURCE_BUDGET_CHARS = 60_000  # chapter chars sent to the song model; longer chapters are trimmed by relevance
+SOURCE_MIN_PART_CHARS = 2_000  # stop filling once less room than this is left
+_RE_TERM = re.compile(r"[a-z0-9]{4,}")
+
+def _select_source(text, focus_topic="", budget=SOURCE_BUDGET_CHARS):
     """
-    Generate songs using the model. Prompt strictly enforces:
-    - aesthetic ad-libs then exact 'beyond the notz' line
-    - strict section order with chorus repeated >=5 times
-    - verses <=6 lines each
-    Post-process lyrics to reduce numeric/formula noise.
+    Fit condensed chapter text into `budget` chars by keeping the most relevant paragraphs
+    (TF-IDF against the focus topic, or the chapter's own top terms) in original order,
+    instead of slicing off the back of the chapter.
     """
-    if not api_key:
-        st.error("Missing Google API key. Please enter it in the sidebar.")
-        return None
+    if len(text) <= budget:
+        return text
+    paras = [p for p in text.split("\n\n") if p.strip()]
+    para_terms = [Counter(t for t in _RE_TERM.findall(p.lower()) if t not in STOPWORDS) for p in paras]
+    df = Counter()
+    for terms in para_terms:
+        df.update(terms.keys())
+    query = [t for t in _RE_TERM.findall((focus_topic or "").lower()) if t not in STOPWORDS]
+    if not query:
+        query = [t for t, _ in df.most_common(20)]
+    n = len(paras)
+    idf = {t: math.log((n + 1) / (df[t] + 1)) + 1.0 for t in query}
 
-    try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-    except Exception as e:
-        st.error(f"Model init error: {e}")
-        return None
+    def score(i):
+        terms = para_terms[i]
+        total = sum(terms.values()) or 1
+        return sum(terms[t] * w for t, w in idf.items()) / total
 
-    style_list_str = ", ".join(styles)
-    language_instruction = "Balanced Hinglish"
-    if language_mix < 30:
-        language_instruction = "Mostly Hindi (with English scientific terms)"
-    elif language_mix > 70:
-        language_instruction = "Mostly English (with Hindi connectors)"
+    keep, used = {}, 0
+    for i in sorted(range(n), key=score, reverse=True):
+        room = budget - used
+        if room < SOURCE_MIN_PART_CHARS:
+            break
+        size = len(paras[i]) + 2
+        if size > room:
+            # paragraphs are whole pages once blank lines are collapsed: cut an oversized
+            # relevant one down to the room left rather than dropping it
+            keep[i] = paras[i][:room - 2]
+            break
+        keep[i] = paras[i]
+        used += size
+    if not keep:
+        return text[:budget]
+    return "\n\n".join(keep[i] for i in sorted(keep))
 
-    focus_instruction = f"Focus specifically on this topic: {focus_topic}" if focus_topic else "Cover the most important exam topics from the chapter."
-    artist_instruction = f"Take inspiration from the style of: {artist_ref}" if artist_ref else ""
-    custom_instructions = f"USER SPECIAL INSTRUCTIONS: {additional_instructions}" if additional_instructions else ""
+SONGS_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "songs": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "type": {"type": "STRING"},
+                    "title": {"type": "STRING"},
+                    "vibe_description": {"type": "STRING"},
+                    "lyrics": {"type": "STRING"},
+                },
+                "required": ["type", "title", "lyrics"],
+            },
+        }
+    },
+    "required": ["songs"],
+}
+SONGS_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": SONGS_RESPONSE_SCHEMA,
+}
 
-    if duration_minutes <= 1.5:
-        structure = "Quick: CHORUS -> VERSE -> CHORUS -> OUTRO (approx 150 words)"
-    elif duration_minutes <= 2.5:
-        structure = "Radio: CHORUS -> VERSE -> CHORUS -> VERSE -> CHORUS (200-250 words)"
-    elif duration_minutes <= 3.5:
-        structure = "Full: Intro/adlibs -> CHORUS -> VERSE -> CHORUS -> VERSE -> CHORUS -> Outro"
-    else:
-        structure = "Extended: multiple chorus/verse repeats to fit duration"
+JSON_OUTPUT_RULES = """8) Return ONLY valid JSON (no commentary) with this structure:
+{
+  "songs": [
+    {
+      "type": "Style Name",
+      "title": "Creative Song Title",
+      "vibe_description": "Suno-style production notes (instruments, BPM, mood)",
+      "lyrics": "Full lyrics text with the exact labels and sequence above"
+    }
+  ]
+}
+"""
 
-    source_snippet = text_content[:200000]
+BLOCK_OUTPUT_RULES = """8) Return ONLY song blocks in this exact plain-text format (no JSON, no markdown, no commentary), one block per song:
+TYPE: Style Name
+TITLE: Creative Song Title
+VIBE: Suno-style production notes (instruments, BPM, mood)
+LYRICS:
+Full lyrics text with the exact labels and sequence above
+--END--
+"""
+
+# Song prompt: stable prefix (chapter text + rules, identical for every style of a PDF) first,
+# small per-request settings last, so the prefix can be served from Gemini's context cache.
+# Strict prompt — enforces single-word chorus label blocks and structure
+SONG_PROMPT_PREFIX = """
+SOURCE_EXCERPT:
+{source_snippet}
 
-    # Strict prompt — enforces single-word chorus label blocks and structure
-    prompt = f"""
 You are an expert Gen-Z musical edu-tainer who writes short, funny, punchy, study-friendly songs.
 IMPORTANT STRUCTURE & RULES (must follow exactly):
 1) The song MUST START with 1-3 short aesthetic ad-libs (examples: "yeahh", "aye vibe", "mmm-hmm").
@@ -273,63 +664,437 @@ IMPORTANT STRUCTURE & RULES (must follow exactly):
 5) CHORUS should be 2-6 lines and must include the phrase "beyond the notz" at least once.
 6) Avoid long formulas and numeric dumps. You may include at most 1-2 very short hints (e.g., "F = ma", "valency 4") — no derivations, no multi-line equations.
 7) Keep language Hinglish (Hindi+English) unless the user asked otherwise. Add light, classroom-safe humour.
-8) Return ONLY valid JSON (no commentary) with this structure:
-{{
-  "songs": [
-    {{
-      "type": "Style Name",
-      "title": "Creative Song Title",
-      "vibe_description": "Suno-style production notes (instruments, BPM, mood)",
-      "lyrics": "Full lyrics text with the exact labels and sequence above"
-    }}
-  ]
-}}
-
-SOURCE_EXCERPT:
-{source_snippet}
+{output_rules}
+"""
 
+SONG_PROMPT_SETTINGS = """
 USER SETTINGS:
-Styles: {style_list_str}
+Styles: {styles}
 Language mix: {language_instruction}
 Focus: {focus_instruction}
 Artist inspo: {artist_instruction}
 Duration: {duration_minutes} minutes
 Extra instructions: {custom_instructions}
 """
+
+def parse_songs_from_text(raw_text):
+    """Parse TYPE/TITLE/VIBE/LYRICS blocks terminated by --END-- into the same {"songs": [...]} shape as the JSON mode."""
+    songs = [
+        {"type": t.strip(), "title": title.strip(), "vibe_description": vibe.strip(), "lyrics": lyrics.strip()}
+        for t, title, vibe, lyrics in _RE_SONG_BLOCK.findall(raw_text or "")
+    ]
+    return {"songs": songs} if songs else None
+
+def _make_song_stream_scanner(output_format):
+    """
+    Incremental scanner for a streamed song response. Returns feed(piece) -> list of
+    song dicts whose JSON object (inside "songs": [...]) or --END-- block completed
+    within that piece.
+    """
+    if output_format == "blocks":
+        pending = [""]
+
+        def feed_blocks(piece):
+            pending[0] += piece
+            done = []
+            end = pending[0].find("--END--")
+            while end != -1:
+                parsed = parse_songs_from_text(pending[0][:end + 7])
+                if parsed:
+                    done.extend(parsed["songs"])
+                pending[0] = pending[0][end + 7:]
+                end = pending[0].find("--END--")
+            return done
+        return feed_blocks
+
+    depth = 0
+    in_str = False
+    esc = False
+    obj = []
+
+    def feed_json(piece):
+        nonlocal depth, in_str, esc
+        done = []
+        for c in piece:
+            if depth >= 2:
+                obj.append(c)
+            if in_str:
+                if esc:
+                    esc = False
+                elif c == "\\":
+                    esc = True
+                elif c == '"':
+                    in_str = False
+            elif c == '"':
+                in_str = depth > 0
+            elif c == "{":
+                depth += 1
+                if depth == 2:
+                    obj[:] = ["{"]
+            elif c == "}" and depth:
+                depth -= 1
+                if depth == 1:
+                    try:
+                        song = json_loads("".join(obj))
+                    except Exception:
+                        song = None
+                    if isinstance(song, dict):
+                        done.append(song)
+        return done
+    return feed_json
+
+def _chunk_text(chunk):
+    """Text of one streamed response chunk ('' for chunks without text parts)."""
+    try:
+        return chunk.text or ""
+    except Exception:
+        return ""
+
+def language_band(language_mix):
+    """The slider only matters through these three prompt bands."""
+    if language_mix < 30:
+        return "Mostly Hindi (with English scientific terms)"
+    if language_mix > 70:
+        return "Mostly English (with Hindi connectors)"
+    return "Balanced Hinglish"
+
+CONTEXT_CACHE_MIN_CHARS = 16_000  # explicit context caches need a few thousand tokens to be accepted
+CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)  # server-side lifetime of the Gemini cache
+# drop our handle well before Gemini expires the cache, so no request hits an expired cache
+CONTEXT_CACHE_HANDLE_TTL = CONTEXT_CACHE_TTL - datetime.timedelta(minutes=5)
+
+@st.cache_resource(ttl=CONTEXT_CACHE_HANDLE_TTL, show_spinner=False)
+def _cached_prefix_model(prefix_hash, _prefix, model_name, key_fingerprint):
+    """
+    Upload the shared prompt prefix once as a Gemini context cache (1h) and return a
+    model bound to it; per-style requests then only send their settings.
+    """
+    genai = _get_genai(api_key)
+    cache = genai.caching.CachedContent.create(
+        model=f"models/{model_name}",
+        contents=[_prefix],
+        ttl=CONTEXT_CACHE_TTL,
+    )
+    return genai.GenerativeModel.from_cached_content(cached_content=cache)
+
+_SONG_REQUIRED = tuple(SONGS_RESPONSE_SCHEMA["properties"]["songs"]["items"]["required"])
+
+def _valid_songs(parsed):
+    """
+    Songs from a parsed response that satisfy SONGS_RESPONSE_SCHEMA's required string fields
+    (one pass; malformed items are dropped), or None if the shape is wrong or nothing is usable.
+    """
+    songs = parsed.get("songs") if isinstance(parsed, dict) else None
+    if not isinstance(songs, list):
+        return None
+    valid = [
+        song for song in songs
+        if isinstance(song, dict) and all(isinstance(song.get(f), str) for f in _SONG_REQUIRED)
+        and song["lyrics"].strip()
+    ]
+    return valid or None
+
+def _parse_song_response(raw_text, output_format):
+    """Parse a full song response into {"songs": [...]} with cleaned lyrics, or None."""
+    if output_format == "blocks":
+        parsed = parse_songs_from_text(raw_text)
+    else:
+        # structured output mode guarantees JSON, so no fence stripping / raw-text fallback
+        parsed = try_parse_json(raw_text.strip())
+    songs = _valid_songs(parsed)
+    if songs is None:
+        return None
+    # Post-process lyrics: reduce formulas and numbers
+    for s in songs:
+        s["lyrics"] = clean_lyrics(s["lyrics"])
+    return {"songs": songs}
+
+def _generate_text(model, prompt, generation_config):
+    resp = call_with_backoff(model.generate_content, prompt, generation_config=generation_config,
+                             request_options=SONGS_REQUEST_OPTIONS)
+    return resp.text
+
+def _generate_songs_fanout(model, prompts, styles, generation_config, output_format):
+    """
+    Run one song request per style concurrently and merge the results (in style order).
+    Network-bound calls on a thread pool; parsing and UI updates stay on the script thread.
+    """
+    by_style = {}
+    status = []
+    ready = st.empty()
+    try:
+        with ThreadPoolExecutor(max_workers=min(SONG_FANOUT_WORKERS, len(prompts))) as ex:
+            futures = {ex.submit(_generate_text, model, p, generation_config): style
+                       for p, style in zip(prompts, styles)}
+            for fut in as_completed(futures):
+                style = futures[fut]
+                try:
+                    parsed = _parse_song_response(fut.result(), output_format)
+                except Exception as e:
+                    parsed = None
+                    if DEBUG:
+                        st.exception(e)
+                if parsed:
+                    by_style[style] = parsed["songs"]
+                    status.append(f"✅ **{style}** ready")
+                else:
+                    status.append(f"⚠️ **{style}** failed")
+                ready.markdown("\n\n".join(status))
+    finally:
+        ready.empty()
+    songs = [song for style in styles for song in by_style.get(style, [])]
+    if not songs:
+        st.error("No style returned usable songs. Try again.")
+        return None
+    failed = [s for s in styles if s not in by_style]
+    if failed:
+        st.warning(f"Some styles failed: {', '.join(failed)}")
+        return {"songs": songs, "failed_styles": failed}
+    return {"songs": songs}
+
+def generate_songs(text_content, styles, language_mix, artist_ref, focus_topic, additional_instructions, duration_minutes, output_format="json", model_name=MODEL_NAME):
+    """
+    Generate songs using the model. Prompt strictly enforces:
+    - aesthetic ad-libs then exact 'beyond the notz' line
+    - strict section order with chorus repeated >=5 times
+    - verses <=6 lines each
+    `output_format` is "json" (schema-enforced structured output) or "blocks"
+    (plain-text TYPE/TITLE/VIBE/LYRICS blocks, no escaping of lyric newlines).
+    `model_name` picks the song model (MODEL_NAME, Flash unless overridden, by default).
+    A single style streams into a live preview; several styles fan out into one
+    concurrent request each.
+    Post-process lyrics to reduce numeric/formula noise.
+    """
+    if not api_key:
+        st.error("Missing Google API key. Please enter it in the sidebar.")
+        return None
+
     try:
-        resp = model.generate_content(prompt)
+        model = get_model(model_name)
     except Exception as e:
-        tb = traceback.format_exc()
-        st.error(f"AI call error: {e}\n\n{tb}")
+        st.error(f"Model init error: {e}")
         return None
 
-    raw_text = ""
+    language_instruction = language_band(language_mix)
+
+    focus_instruction = f"Focus specifically on this topic: {focus_topic}" if focus_topic else "Cover the most important exam topics from the chapter."
+    artist_instruction = f"Take inspiration from the style of: {artist_ref}" if artist_ref else ""
+    custom_instructions = f"USER SPECIAL INSTRUCTIONS: {additional_instructions}" if additional_instructions else ""
+
+    source_snippet = _select_source(_condense(text_content), focus_topic)
+
+    if output_format == "blocks":
+        output_rules = BLOCK_OUTPUT_RULES
+        generation_config = None
+    else:
+        output_rules = JSON_OUTPUT_RULES
+        generation_config = SONGS_GENERATION_CONFIG
+
+    prompt_prefix = SONG_PROMPT_PREFIX.format(source_snippet=source_snippet, output_rules=output_rules)
+    settings_fields = {
+        "language_instruction": language_instruction,
+        "focus_instruction": focus_instruction,
+        "artist_instruction": artist_instruction,
+        "duration_minutes": duration_minutes,
+        "custom_instructions": custom_instructions,
+    }
+
+    def _settings_for(style_list_str):
+        return SONG_PROMPT_SETTINGS.format(styles=style_list_str, **settings_fields)
+
+    if len(styles) > 1:
+        # one smaller request per style, all in flight at once: wall time ~ slowest style, not the sum
+        fan_model, prompts = model, [prompt_prefix + _settings_for(style) for style in styles]
+        if len(prompt_prefix) >= CONTEXT_CACHE_MIN_CHARS:
+            try:
+                prefix_hash = hashlib.blake2b(prompt_prefix.encode(), digest_size=16).hexdigest()
+                fan_model = _cached_prefix_model(prefix_hash, prompt_prefix, model_name, api_key_fingerprint())
+                prompts = [_settings_for(style) for style in styles]
+            except Exception:
+                pass  # caching unavailable (quota, model, size): send full prompts
+        return _generate_songs_fanout(fan_model, prompts, styles, generation_config, output_format)
+
+    prompt = prompt_prefix + _settings_for(", ".join(styles))
+    # stream the response so the user sees text as soon as the first tokens arrive,
+    # and announce each song as soon as its object/block closes
+    buf = []
+    preview = st.empty()
+    ready = st.empty()
+    ready_titles = []
+    scan = _make_song_stream_scanner(output_format)
     try:
-        raw_text = resp.text if hasattr(resp, "text") else str(resp)
-    except Exception:
-        raw_text = str(resp)
-
-    cleaned = raw_text.replace("```json", "").replace("```", "").strip()
-    parsed = try_parse_json(cleaned)
-    if parsed and isinstance(parsed, dict) and "songs" in parsed:
-        # Post-process lyrics: reduce formulas and numbers
-        for s in parsed.get("songs", []):
-            s["lyrics"] = clean_lyrics(s.get("lyrics", ""))
+        tail = ""
+        # retries cover opening the stream (the first chunk); a stream that dies midway is not replayed
+        for chunk in call_with_backoff(model.generate_content, prompt, generation_config=generation_config,
+                                       stream=True, request_options=SONGS_REQUEST_OPTIONS):
+            piece = _chunk_text(chunk)
+            if not piece:
+                continue
+            buf.append(piece)
+            tail = (tail + piece)[-2000:]
+            preview.code(tail, language=None)
+            new_songs = scan(piece)
+            if new_songs:
+                ready_titles.extend(f"✅ **{s.get('title', 'Untitled')}** — {s.get('type', '')}" for s in new_songs)
+                ready.markdown("\n\n".join(ready_titles))
+    except Exception as e:
+        st.error(f"AI call error: {type(e).__name__}: {e}")
+        if DEBUG:
+            st.exception(e)
+        return None
+    finally:
+        preview.empty()
+        ready.empty()
+    parsed = _parse_song_response("".join(buf), output_format)
+    if parsed:
         return parsed
-    else:
-        st.warning("Model didn't return clean JSON. Showing raw output as fallback (post-processed).")
-        fallback_lyrics = clean_lyrics(cleaned)
-        fallback = {
-            "songs": [
-                {
-                    "type": styles[0] if styles else "Custom",
-                    "title": "BTN Originals — fallback output",
-                    "vibe_description": cleaned[:800],
-                    "lyrics": fallback_lyrics
-                }
-            ]
-        }
-        return fallback
+    st.error("Model response could not be parsed (it may have been cut off). Try again.")
+    return None
+
+# --- CACHED WRAPPERS ---
+# Streamlit reruns the whole script on every interaction; identical (PDF + settings)
+# pairs reuse earlier model output instead of repeating minute-long Gemini calls.
+
+def content_key(digest, settings=None):
+    """Stable cache key for the uploaded PDF (by `pdf_digest`) plus (optional) prompt settings."""
+    h = hashlib.blake2b(digest.encode())
+    if settings is not None:
+        h.update(json_dumps(settings, sort_keys=True).encode())
+    return h.hexdigest()
+
+def canonical_styles(styles):
+    """Stripped, non-empty styles, de-duplicated case-insensitively (first spelling and order kept)."""
+    by_fold = {}
+    for style in styles:
+        style = style.strip()
+        if style:
+            by_fold.setdefault(style.casefold(), style)
+    return list(by_fold.values())
+
+def song_cache_key(digest, settings):
+    """
+    Cache key for generate_songs that collapses requests producing the same prompt:
+    the language slider is reduced to its prompt band and free-text fields are
+    whitespace/case-normalised. Styles are keyed exactly as sent to the model, so
+    pass them through `canonical_styles` first.
+    """
+    canon = dict(settings)
+    canon["language_mix"] = language_band(settings["language_mix"])
+    for field in ("artist_ref", "focus_topic", "additional_instructions"):
+        canon[field] = " ".join((settings.get(field) or "").split()).casefold()
+    canon["styles"] = list(settings["styles"])
+    return content_key(digest, canon)
+
+def api_key_fingerprint():
+    return hashlib.sha256(api_key.encode()).hexdigest() if api_key else ""
+
+RESULT_DB_PATH = os.environ.get("RESULT_CACHE_DB", "song_cache.db")
+RESULT_DB_TTL = 7 * 24 * 3600  # seconds a stored answer stays valid
+
+def _result_db():
+    conn = sqlite3.connect(RESULT_DB_PATH, timeout=5, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS songs (key TEXT PRIMARY KEY, created_at REAL, data BLOB)")
+    return conn
+
+def load_stored(key):
+    """Model result persisted by an earlier session/process for `key`, or None (missing, expired, unreadable)."""
+    try:
+        with closing(_result_db()) as conn:
+            row = conn.execute("SELECT data FROM songs WHERE key=? AND created_at>?",
+                               (key, time.time() - RESULT_DB_TTL)).fetchone()
+        return json_loads(zlib.decompress(row[0])) if row else None
+    except Exception:
+        return None
+
+def store_result(key, data):
+    """Persist a model result (zlib-compressed JSON), pruning expired rows; failures only cost the cache."""
+    try:
+        blob = zlib.compress(json_dumps(data).encode(), 6)
+        now = time.time()
+        with closing(_result_db()) as conn:
+            # expired rows are never read again; drop them so the file doesn't grow forever
+            conn.execute("DELETE FROM songs WHERE created_at < ?", (now - RESULT_DB_TTL,))
+            conn.execute("INSERT OR REPLACE INTO songs (key, created_at, data) VALUES (?, ?, ?)",
+                         (key, now, blob))
+    except Exception:
+        pass
+
+class SongGenerationError(Exception):
+    """generate_songs produced nothing usable (the reason was already shown via st.error)."""
+
+class PartialSongsError(SongGenerationError):
+    """Some fan-out styles failed; `result` holds the songs that did arrive (shown, never cached)."""
+    def __init__(self, result):
+        super().__init__(f"failed styles: {', '.join(result.get('failed_styles', []))}")
+        self.result = result
+
+SONG_MEMO_TTL = 3600  # seconds a song result stays in the in-process store
+SONG_MEMO_MAX = 32  # entries kept, least recently used evicted first
+
+@st.cache_resource(show_spinner=False)
+def _song_memo():
+    # a plain dict, not st.cache_data: generate_songs draws its live preview and status
+    # lines, and st.cache_data would record those element updates and replay them on every hit
+    return {"lock": threading.Lock(), "items": OrderedDict()}
+
+def _memo_get(key):
+    memo = _song_memo()
+    with memo["lock"]:
+        item = memo["items"].get(key)
+        if item is None or time.time() - item[0] > SONG_MEMO_TTL:
+            return None
+        memo["items"].move_to_end(key)
+        return item[1]
+
+def _memo_put(key, result):
+    memo = _song_memo()
+    with memo["lock"]:
+        memo["items"][key] = (time.time(), result)
+        memo["items"].move_to_end(key)
+        while len(memo["items"]) > SONG_MEMO_MAX:
+            memo["items"].popitem(last=False)
+
+def cached_generate_songs(key, text_content, settings):
+    """
+    Song result for `key`: in-process store first, then SQLite (survives restarts and new
+    sessions), then an uncached generate_songs call. Failures and partial fan-outs raise and
+    are never stored, so the next click retries.
+    """
+    result = _memo_get(key)
+    if result is not None:
+        return result
+    db_key = f"songs:{key}"  # the model name is part of the settings behind `key`
+    result = load_stored(db_key)
+    if result is None:
+        result = generate_songs(text_content, **settings)
+        if not result:
+            raise SongGenerationError()
+        if result.get("failed_styles"):
+            # partial fan-out: show it, but keep it out of both stores so failed styles get retried
+            raise PartialSongsError(result)
+        store_result(db_key, result)
+    _memo_put(key, result)
+    return result
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def cached_keywords_per_page(key, _text_content, max_pages=35, api_key_hash=""):
+    # api_key_hash only keys the cache (model vs. local fallback output); the key itself is never stored
+    if not api_key_hash:
+        return generate_keywords_per_page(_text_content, max_pages=max_pages)
+    db_key = f"keywords:{KEYWORD_MODEL_NAME}:{max_pages}:{key}"  # only model output is worth persisting
+    stored = load_stored(db_key)
+    if stored is not None:
+        return stored
+    return generate_keywords_per_page(_text_content, max_pages=max_pages, persist_key=db_key)
+
+def script_thread_pool(max_workers):
+    """ThreadPoolExecutor whose workers share this script run's context (so st.* calls inside them work)."""
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+    )
 
 # --- UI: Sidebar controls ---
 st.sidebar.header("🎛️ Studio Controls")
@@ -354,6 +1119,16 @@ st.sidebar.subheader("✨ Fine Tuning")
 artist_ref = st.sidebar.text_input("Artist Inspiration (Optional)", placeholder="e.g. Divine, Arijit Singh")
 focus_topic = st.sidebar.text_input("Focus Topic (Optional)", placeholder="e.g. Soaps, Covalent Bonding")
 additional_instructions = st.sidebar.text_area("📝 Additional Instructions", placeholder="e.g. keep it funny, short formulas only", height=100)
+output_format = st.sidebar.radio(
+    "🧾 Model output format",
+    options=["json", "blocks"],
+    format_func=lambda f: {"json": "Structured JSON", "blocks": "Plain-text blocks"}[f],
+    horizontal=True,
+    help="Plain-text blocks skip JSON escaping of lyrics",
+)
+model_name = st.sidebar.selectbox("🧠 Model", MODEL_OPTIONS, index=0, help="Flash is much faster; Pro is slower and pricier")
+extract_keywords = st.sidebar.checkbox("🔎 Also extract per-page keywords", value=False, help="Runs an extra (lighter) model pass over the chapter pages")
+DEBUG = st.sidebar.checkbox("🐞 Debug mode", False, help="Show full tracebacks on errors")
 
 # --- MAIN UI ---
 st.title("🎹 BTN Originals")
@@ -363,52 +1138,94 @@ if "song_data" not in st.session_state:
     st.session_state.song_data = None
 if "keywords_per_page" not in st.session_state:
     st.session_state.keywords_per_page = None
+if "chapter_text" not in st.session_state:
+    st.session_state.chapter_text = None
+    st.session_state.chapter_key = None
+if "pdf_upload_id" not in st.session_state:
+    st.session_state.pdf_upload_id = None
+    st.session_state.pdf_digest = None
 
 uploaded_file = st.file_uploader("📂 Upload Chapter PDF (up to 35 pages read)", type=["pdf"])
 
+def upload_digest(uploaded_file):
+    """pdf_digest of the upload, hashed once per uploaded file and remembered for this session."""
+    upload_id = getattr(uploaded_file, "file_id", None) or (uploaded_file.name, uploaded_file.size)
+    if st.session_state.pdf_upload_id != upload_id:
+        st.session_state.pdf_digest = pdf_digest(uploaded_file)
+        st.session_state.pdf_upload_id = upload_id
+    return st.session_state.pdf_digest
+
+def copy_buttons_html(items):
+    """Several copy buttons in one snippet, so a tab needs one components.html iframe instead of one per button."""
+    buttons = "".join(
+        f"""
+    <button onclick="navigator.clipboard.writeText({escape(json_dumps(text))})" 
+            style="padding:6px 10px;margin-right:6px;border-radius:6px;border:1px solid #ddd;background:#fff;cursor:pointer;font-weight:600;">
+      {label}
+    </button>"""
+        for label, text in items
+    )
+    return f"<div>{buttons}\n    </div>"
+
 def copy_button_html(text_to_copy):
-    js_text = json.dumps(text_to_copy)
-    html = f"""
-    <button onclick='navigator.clipboard.writeText({js_text})' 
-            style="padding:6px 10px;border-radius:6px;border:1px solid #ddd;background:#fff;cursor:pointer;font-weight:600;">
-      📋 Copy
-    </button>
-    """
-    return html
+    return copy_buttons_html([("📋 Copy", text_to_copy)])
 
 if uploaded_file is not None:
     if st.button("🚀 Generate Tracks"):
-        final_styles = selected_styles.copy()
-        if custom_style_input and custom_style_input.strip():
-            if custom_style_input not in final_styles:
-                final_styles.append(custom_style_input)
+        final_styles = canonical_styles(selected_styles + [custom_style_input or ""])
 
         if not api_key:
             st.warning("Please provide a Google API Key in the sidebar.")
         elif not final_styles:
             st.warning("Please select at least one style.")
         else:
-            with st.spinner("📄 Extracting up to 35 pages..."):
-                chapter_text = extract_text_from_pdf(uploaded_file, max_pages=35)
+            digest = upload_digest(uploaded_file)
+            chapter_key = content_key(digest)
+            if st.session_state.chapter_key == chapter_key and st.session_state.chapter_text:
+                # same upload as the results on screen: reuse its text, no re-extraction
+                chapter_text = st.session_state.chapter_text
+            else:
+                with st.spinner("📄 Extracting up to 35 pages..."):
+                    chapter_text = extract_text_from_pdf(uploaded_file, max_pages=35, digest=digest)
             if not chapter_text:
                 st.error("Failed to extract text from PDF or PDF was empty.")
             else:
+                settings = {
+                    "styles": final_styles,
+                    "language_mix": lang_mix,
+                    "artist_ref": artist_ref,
+                    "focus_topic": focus_topic,
+                    "additional_instructions": additional_instructions,
+                    "duration_minutes": duration_minutes,
+                    "output_format": output_format,
+                    "model_name": model_name,
+                }
+                # keywords per page are opt-in (one line per page, up to 10 single-word keywords each);
+                # both jobs wait on the network, so keywords start first on a worker thread and
+                # run underneath the song call
+                ex = script_thread_pool(max_workers=1)
+                fut_kw = ex.submit(cached_keywords_per_page, chapter_key, chapter_text, 35, api_key_fingerprint()) if extract_keywords else None
                 with st.spinner("🎧 Composing tracks (may take up to 2-3 minutes for longer input)..."):
-                    result = generate_songs(
-                        chapter_text,
-                        final_styles,
-                        lang_mix,
-                        artist_ref,
-                        focus_topic,
-                        additional_instructions,
-                        duration_minutes
-                    )
+                    try:
+                        result = cached_generate_songs(song_cache_key(digest, settings), chapter_text, settings)
+                    except PartialSongsError as e:
+                        result = e.result
+                    except SongGenerationError:
+                        result = None
+                keywords = None
+                if result and fut_kw is not None:
+                    if not fut_kw.done():
+                        with st.spinner("🔎 Finishing per-page keywords..."):
+                            wait([fut_kw], timeout=KEYWORD_REQUEST_OPTIONS["timeout"])
+                    if fut_kw.done() and fut_kw.exception() is None:
+                        keywords = fut_kw.result()
+                ex.shutdown(wait=False)
                 if result:
                     st.session_state.song_data = result
-                    # --- NEW: generate keywords per page (one line per page, up to 10 single-word keywords each)
-                    with st.spinner("🔎 Extracting 10 single-word keywords per page..."):
-                        st.session_state.keywords_per_page = generate_keywords_per_page(chapter_text, max_pages=35)
-                    st.rerun()
+                    st.session_state.chapter_text = chapter_text
+                    st.session_state.chapter_key = chapter_key
+                    st.session_state.keywords_per_page = keywords
+                    # no st.rerun(): the results section below renders from session state in this same run
                 else:
                     st.error("No data returned from model. Try again or simplify inputs.")
 
@@ -429,16 +1246,21 @@ if st.session_state.song_data:
                     st.subheader(song.get("title", f"Track {i+1}"))
                     st.markdown("**Lyrics**")
                     st.code(song.get("lyrics", ""), language=None)
-                    components.html(copy_button_html(song.get("lyrics", "")), height=44)
+                    # both copy buttons share one iframe
+                    components.html(copy_buttons_html([
+                        ("📋 Copy lyrics", song.get("lyrics", "")),
+                        ("📋 Copy prompt", song.get("vibe_description", "")),
+                    ]), height=44)
                 with col2:
                     st.info("🎹 AI Production Prompt")
                     st.markdown(f"_{song.get('vibe_description', '')}_")
-                    components.html(copy_button_html(song.get("vibe_description", "")), height=44)
                     st.markdown("---")
                     st.success("✨ Tip: Paste this prompt into Suno.ai or your DAW.")
                     if st.button("🗑️ Clear Results", key=f"clear_{i}"):
                         st.session_state.song_data = None
                         st.session_state.keywords_per_page = None
+                        st.session_state.chapter_text = None
+                        st.session_state.chapter_key = None
                         st.rerun()
 
     # --- KEYWORDS PER PAGE (one line per page) ---
@@ -447,5 +1269,9 @@ if st.session_state.song_data:
     if st.session_state.keywords_per_page:
         st.code(st.session_state.keywords_per_page, language=None)
         components.html(copy_button_html(st.session_state.keywords_per_page), height=44)
+    elif st.session_state.chapter_text and st.button("🔎 Extract keywords now"):
+        with st.spinner("🔎 Extracting 10 single-word keywords per page..."):
+            st.session_state.keywords_per_page = cached_keywords_per_page(st.session_state.chapter_key, st.session_state.chapter_text, 35, api_key_fingerprint())
+        st.rerun()
     else:
-        st.info("Keywords per page not generated. Generate tracks to produce them.")
+        st.info("Keywords per page not generated. Tick \"Also extract per-page keywords\" in the sidebar or click above.")